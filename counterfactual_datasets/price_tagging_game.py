@@ -1,4 +1,4 @@
-import os, random, argparse, sys, pickle, time, datasets
+import os, random, argparse, sys, pickle, time, datasets, functools
 import torch
 from torch.utils.data import DataLoader, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
@@ -26,6 +26,63 @@ from transformers.utils import logging
 logging.set_verbosity_info()
 logger = logging.get_logger("transformers")
 
+task_names = [
+    "pricing_tag_lb",
+    "pricing_tag_ub",
+    "pricing_tag_lub",
+    "pricing_tag_mid_diff",
+    "pricing_tag_bracket",
+    "pricing_tag_fixed",
+]
+
+# labels are carried around as int codes, and only turned into
+# strings / token ids (indexed by the code) at the tokenizer boundary.
+no_label, yes_label = 0, 1
+label_strs = ["No", "Yes"]
+ctf_labels = [yes_label, no_label]
+
+# (base region, source region) pairs that lead to each counterfactual label,
+# where region 1/2/3 is below/within/above the bounds. built once here
+# instead of on every sampled example.
+lower_bound_base_source_regions = {
+    yes_label: [
+        [1,2],
+        [1,3],
+        [2,2],
+    ],
+    no_label: [
+        [1,1],
+        [2,1],
+        [2,3],
+        [3,1],
+        [3,2],
+        [3,3]
+    ],
+}
+upper_bound_base_source_regions = {
+    yes_label: [
+        [3,2],
+        [3,1],
+        [2,2],
+    ],
+    no_label: [
+        [1,1],
+        [1,2],
+        [1,3],
+        [2,1],
+        [2,3],
+        [3,3]
+    ],
+}
+
+@functools.lru_cache(maxsize=8)
+def yes_no_token_ids(tokenizer):
+    # labels are looked up for every sampled example, so resolve them
+    # once per tokenizer instead of going through the tokenizer each time.
+    return [
+        tokenizer.convert_tokens_to_ids(label_str) for label_str in label_strs
+    ]
+
 def pricing_tag_game_config_sampler(
     amount,
     lower_bound,
@@ -48,7 +105,7 @@ def pricing_tag_game_config_sampler(
         
     return lower_bound_sample, upper_bound_sample, amount_sample
 
-def pricing_tag_game_example_sampler(
+def pricing_tag_game_prompt_sampler(
     tokenizer,
     amount,
     lower_bound,
@@ -61,16 +118,29 @@ def pricing_tag_game_example_sampler(
     )
     lower_bound_str = "%.2f" % lower_bound_sample
     upper_bound_str = "%.2f" % upper_bound_sample
-    if amount_sample >= float(lower_bound_str) and amount_sample <= float(upper_bound_str):
-        label = tokenizer.convert_tokens_to_ids("Yes")
-    else:
-        label = tokenizer.convert_tokens_to_ids("No")
+    is_in_bounds = amount_sample >= float(lower_bound_str) and amount_sample <= float(upper_bound_str)
+    label = yes_no_token_ids(tokenizer)[int(is_in_bounds)]
 
     amount_str = "%.2f dollars" % amount_sample
     instruction = f"Please say yes only if it costs between {lower_bound_str} and {upper_bound_str} dollars, otherwise no."
     alpaca_prompt = alpaca_prompt_template % (instruction, amount_str)
+    
+    return alpaca_prompt, label
+
+def pricing_tag_game_example_sampler(
+    tokenizer,
+    amount,
+    lower_bound,
+    bound_width,
+):
+    alpaca_prompt, label = pricing_tag_game_prompt_sampler(
+        tokenizer,
+        amount,
+        lower_bound,
+        bound_width
+    )
     input_ids = tokenizer(alpaca_prompt, return_tensors="pt").input_ids[0]
-    output_ids = (torch.ones(input_ids.shape[0])*-100).long().tolist()
+    output_ids = [-100]*input_ids.shape[0]
     output_ids[-1] = label
     input_ids = input_ids.tolist()
     assert len(input_ids) == 82
@@ -90,22 +160,52 @@ def pricing_tag_game_example_sampler_with_info(
     )
     lower_bound_str = "%.2f" % lower_bound_sample
     upper_bound_str = "%.2f" % upper_bound_sample
-    if amount_sample >= float(lower_bound_str) and amount_sample <= float(upper_bound_str):
-        label = tokenizer.convert_tokens_to_ids("Yes")
-    else:
-        label = tokenizer.convert_tokens_to_ids("No")
+    is_in_bounds = amount_sample >= float(lower_bound_str) and amount_sample <= float(upper_bound_str)
+    label = yes_no_token_ids(tokenizer)[int(is_in_bounds)]
 
     amount_str = "%.2f dollars" % amount_sample
     instruction = f"Please say yes only if it costs between {lower_bound_str} and {upper_bound_str} dollars, otherwise no."
     alpaca_prompt = alpaca_prompt_template % (instruction, amount_str)
     input_ids = tokenizer(alpaca_prompt, return_tensors="pt").input_ids[0]
-    output_ids = (torch.ones(input_ids.shape[0])*-100).long().tolist()
+    output_ids = [-100]*input_ids.shape[0]
     output_ids[-1] = label
     input_ids = input_ids.tolist()
     assert len(input_ids) == 82
     
     return input_ids, output_ids, (lower_bound_sample, upper_bound_sample, amount_sample)
     
+def encode_prompts(
+    tokenizer,
+    prompts,
+    expected_length=82,
+):
+    all_input_ids = tokenizer(prompts).input_ids
+    for input_ids in all_input_ids:
+        assert len(input_ids) == expected_length
+    return all_input_ids
+
+def encode_prompt_pairs(
+    tokenizer,
+    base_prompts,
+    source_prompts,
+    expected_length=82,
+):
+    # base and source prompts share one tokenizer call; both sides must
+    # come out with the same length for the aligned forward passes.
+    all_input_ids = encode_prompts(
+        tokenizer, base_prompts + source_prompts, expected_length
+    )
+    return all_input_ids[:len(base_prompts)], all_input_ids[len(base_prompts):]
+
+def build_output_ids(
+    all_input_ids,
+    labels,
+):
+    return [
+        [-100]*(len(input_ids)-1) + [label] 
+        for input_ids, label in zip(all_input_ids, labels)
+    ]
+
 def factual_sampler(
     tokenizer,
     max_n_training_examples,
@@ -115,20 +215,24 @@ def factual_sampler(
     bound_width=None,
 ):
     
-    all_input_ids = []
-    all_output_ids = [] # this one does not have input ids, etc..
+    if "pricing_tag" not in game:
+        raise ValueError(f"Factual sampling is not supported for game: {game}")
+    
+    all_prompts = []
+    all_labels = []
     for _ in range(max_n_training_examples):
-        if "pricing_tag" in game:
-            input_ids, output_ids = pricing_tag_game_example_sampler(
-                tokenizer,
-                amount,
-                lower_bound,
-                bound_width
-            )
-        elif game == "continent_retrieval":
-            pass
-        all_input_ids += [input_ids]
-        all_output_ids += [output_ids]
+        alpaca_prompt, label = pricing_tag_game_prompt_sampler(
+            tokenizer,
+            amount,
+            lower_bound,
+            bound_width
+        )
+        all_prompts += [alpaca_prompt]
+        all_labels += [label]
+    
+    # tokenize everything in one call instead of once per example.
+    all_input_ids = encode_prompts(tokenizer, all_prompts)
+    all_output_ids = build_output_ids(all_input_ids, all_labels) # this one does not have input ids, etc..
         
     return all_input_ids, all_output_ids
 
@@ -164,25 +268,10 @@ def lower_bound_alignment_example_sampler(
             bound_width
         )
     
-    ctf_label_str = random.choice(["Yes", "No"])
-    if ctf_label_str == "Yes":
-        ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-        base_source_regions = [
-            [1,2],
-            [1,3],
-            [2,2],
-        ]
-    elif ctf_label_str == "No":
-        ctf_label = tokenizer.convert_tokens_to_ids("No")
-        base_source_regions = [
-            [1,1],
-            [2,1],
-            [2,3],
-            [3,1],
-            [3,2],
-            [3,3]
-        ]
-    base_source_region = random.choice(base_source_regions)
+    ctf_label_code = random.choice(ctf_labels)
+    ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+    ctf_label_str = label_strs[ctf_label_code]
+    base_source_region = random.choice(lower_bound_base_source_regions[ctf_label_code])
     base_region = base_source_region[0]
     source_region = base_source_region[1]
 
@@ -214,25 +303,10 @@ def upper_bound_alignment_example_sampler(
             bound_width
         )
     
-    ctf_label_str = random.choice(["Yes", "No"])
-    if ctf_label_str == "Yes":
-        ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-        base_source_regions = [
-            [3,2],
-            [3,1],
-            [2,2],
-        ]
-    elif ctf_label_str == "No":
-        ctf_label = tokenizer.convert_tokens_to_ids("No")
-        base_source_regions = [
-            [1,1],
-            [1,2],
-            [1,3],
-            [2,1],
-            [2,3],
-            [3,3]
-        ]
-    base_source_region = random.choice(base_source_regions)
+    ctf_label_code = random.choice(ctf_labels)
+    ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+    ctf_label_str = label_strs[ctf_label_code]
+    base_source_region = random.choice(upper_bound_base_source_regions[ctf_label_code])
     base_region = base_source_region[0]
     source_region = base_source_region[1]
     
@@ -253,13 +327,14 @@ def bound_alignment_sampler(
     lower_bound=None,
     bound_width=None,
 ):
-    all_base_input_ids = []
-    all_source_input_ids = []
-    all_ctf_output_ids = [] # this one does not have input ids, etc..
+    all_base_prompts = []
+    all_source_prompts = []
+    all_ctf_labels = []
     all_intervention_ids = []
     
-    for _ in range(max_n_training_examples):
-        bound_functor = random.choice(bound_functors)
+    # draw every example's bound functor up front in one call.
+    sampled_bound_functors = random.choices(bound_functors, k=max_n_training_examples)
+    for bound_functor in sampled_bound_functors:
         base_lower_bound_sample, base_upper_bound_sample, \
             source_lower_bound_sample, source_upper_bound_sample, \
             base_amount_sample, source_amount_sample, \
@@ -277,9 +352,10 @@ def bound_alignment_sampler(
         source_lower_bound_str = "%.2f" % source_lower_bound_sample
         source_upper_bound_str = "%.2f" % source_upper_bound_sample
         
-        # print(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
-        # print(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
-        # print(f"ctf label: {ctf_label_str}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
+            logger.debug(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
+            logger.debug(f"ctf label: {ctf_label_str}")
         
         base_instruction = f"Please say yes only if it costs between {base_lower_bound_str} and {base_upper_bound_str} dollars, otherwise no."
         source_instruction = f"Please say yes only if it costs between {source_lower_bound_str} and {source_upper_bound_str} dollars, otherwise no."
@@ -287,22 +363,18 @@ def bound_alignment_sampler(
         base_alpaca_prompt = alpaca_prompt_template % (base_instruction, base_amount_str)
         source_alpaca_prompt = alpaca_prompt_template % (source_instruction, source_amount_str)
         
-        base_input_ids = tokenizer(base_alpaca_prompt, return_tensors="pt").input_ids[0]
-        source_input_ids = tokenizer(source_alpaca_prompt, return_tensors="pt").input_ids[0]
-        base_input_ids = base_input_ids.tolist()
-        source_input_ids = source_input_ids.tolist()
-        ctf_output_ids = (torch.ones(len(base_input_ids))*-100).long().tolist()
-        ctf_output_ids[-1] = ctf_label
         intervention_id = 0 if bound_functor == bound_functors[0] else 1
         
-        all_base_input_ids += [base_input_ids]
-        all_source_input_ids += [source_input_ids]
+        all_base_prompts += [base_alpaca_prompt]
+        all_source_prompts += [source_alpaca_prompt]
         
-        all_ctf_output_ids += [ctf_output_ids]
+        all_ctf_labels += [ctf_label]
         all_intervention_ids += [intervention_id]
-        
-        assert len(base_input_ids) == 82
-        assert len(source_input_ids) == 82
+    
+    all_base_input_ids, all_source_input_ids = encode_prompt_pairs(
+        tokenizer, all_base_prompts, all_source_prompts
+    )
+    all_ctf_output_ids = build_output_ids(all_base_input_ids, all_ctf_labels) # this one does not have input ids, etc..
         
     return all_base_input_ids, all_source_input_ids, all_ctf_output_ids, all_intervention_ids
 
@@ -314,9 +386,9 @@ def midpoint_alignment_sampler(
     bound_width=None,
 ):
 
-    all_base_input_ids = []
-    all_source_input_ids = []
-    all_ctf_output_ids = [] # this one does not have input ids, etc..
+    all_base_prompts = []
+    all_source_prompts = []
+    all_ctf_labels = []
     all_intervention_ids = []
     
     for _ in range(max_n_training_examples):
@@ -333,17 +405,12 @@ def midpoint_alignment_sampler(
                 lower_bound,
                 bound_width
             )
-        ctf_label = None
-        ctf_label_str = None
         source_mid_point = (source_lower_bound_sample+source_upper_bound_sample)/2.0
         base_half = 0.5*abs(base_upper_bound_sample-base_lower_bound_sample)
         ctf_mid_diff = abs(base_amount_sample-source_mid_point)
-        if ctf_mid_diff <= base_half:
-            ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-            ctf_label_str = "Yes"
-        else:
-            ctf_label = tokenizer.convert_tokens_to_ids("No")
-            ctf_label_str = "No"
+        ctf_label_code = int(ctf_mid_diff <= base_half)
+        ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+        ctf_label_str = label_strs[ctf_label_code]
             
         base_amount_str = "%.2f dollars" % base_amount_sample
         source_amount_str = "%.2f dollars" % source_amount_sample
@@ -352,9 +419,10 @@ def midpoint_alignment_sampler(
         source_lower_bound_str = "%.2f" % source_lower_bound_sample
         source_upper_bound_str = "%.2f" % source_upper_bound_sample
         
-        # print(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
-        # print(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
-        # print(f"ctf label: {ctf_label_str}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
+            logger.debug(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
+            logger.debug(f"ctf label: {ctf_label_str}")
         
         base_instruction = f"Please say yes only if it costs between {base_lower_bound_str} and {base_upper_bound_str} dollars, otherwise no."
         source_instruction = f"Please say yes only if it costs between {source_lower_bound_str} and {source_upper_bound_str} dollars, otherwise no."
@@ -362,19 +430,16 @@ def midpoint_alignment_sampler(
         base_alpaca_prompt = alpaca_prompt_template % (base_instruction, base_amount_str)
         source_alpaca_prompt = alpaca_prompt_template % (source_instruction, source_amount_str)
         
-        base_input_ids = tokenizer(base_alpaca_prompt, return_tensors="pt").input_ids[0]
-        source_input_ids = tokenizer(source_alpaca_prompt, return_tensors="pt").input_ids[0]
-        base_input_ids = base_input_ids.tolist()
-        source_input_ids = source_input_ids.tolist()
-        ctf_output_ids = (torch.ones(len(base_input_ids))*-100).long().tolist()
-        ctf_output_ids[-1] = ctf_label
         
-        all_base_input_ids += [base_input_ids]
-        all_source_input_ids += [source_input_ids]
-        all_ctf_output_ids += [ctf_output_ids]
+        all_base_prompts += [base_alpaca_prompt]
+        all_source_prompts += [source_alpaca_prompt]
+        all_ctf_labels += [ctf_label]
         all_intervention_ids += [0]
-        assert len(base_input_ids) == 82
-        assert len(source_input_ids) == 82
+    
+    all_base_input_ids, all_source_input_ids = encode_prompt_pairs(
+        tokenizer, all_base_prompts, all_source_prompts
+    )
+    all_ctf_output_ids = build_output_ids(all_base_input_ids, all_ctf_labels) # this one does not have input ids, etc..
         
     return all_base_input_ids, all_source_input_ids, all_ctf_output_ids, all_intervention_ids
 
@@ -386,9 +451,9 @@ def bracket_alignment_sampler(
     bound_width=None,
 ):
 
-    all_base_input_ids = []
-    all_source_input_ids = []
-    all_ctf_output_ids = [] # this one does not have input ids, etc..
+    all_base_prompts = []
+    all_source_prompts = []
+    all_ctf_labels = []
     all_intervention_ids = []
     
     for _ in range(max_n_training_examples):
@@ -405,14 +470,11 @@ def bracket_alignment_sampler(
                 lower_bound,
                 bound_width
             )
-        ctf_label = None
-        ctf_label_str = None
-        if base_amount_sample <= source_upper_bound_sample and base_amount_sample >= source_lower_bound_sample:
-            ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-            ctf_label_str = "Yes"
-        else:
-            ctf_label = tokenizer.convert_tokens_to_ids("No")
-            ctf_label_str = "No"
+        ctf_label_code = int(
+            base_amount_sample <= source_upper_bound_sample and base_amount_sample >= source_lower_bound_sample
+        )
+        ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+        ctf_label_str = label_strs[ctf_label_code]
             
         base_amount_str = "%.2f dollars" % base_amount_sample
         source_amount_str = "%.2f dollars" % source_amount_sample
@@ -421,9 +483,10 @@ def bracket_alignment_sampler(
         source_lower_bound_str = "%.2f" % source_lower_bound_sample
         source_upper_bound_str = "%.2f" % source_upper_bound_sample
         
-        # print(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
-        # print(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
-        # print(f"ctf label: {ctf_label_str}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
+            logger.debug(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
+            logger.debug(f"ctf label: {ctf_label_str}")
         
         base_instruction = f"Please say yes only if it costs between {base_lower_bound_str} and {base_upper_bound_str} dollars, otherwise no."
         source_instruction = f"Please say yes only if it costs between {source_lower_bound_str} and {source_upper_bound_str} dollars, otherwise no."
@@ -431,23 +494,52 @@ def bracket_alignment_sampler(
         base_alpaca_prompt = alpaca_prompt_template % (base_instruction, base_amount_str)
         source_alpaca_prompt = alpaca_prompt_template % (source_instruction, source_amount_str)
         
-        base_input_ids = tokenizer(base_alpaca_prompt, return_tensors="pt").input_ids[0]
-        source_input_ids = tokenizer(source_alpaca_prompt, return_tensors="pt").input_ids[0]
-        base_input_ids = base_input_ids.tolist()
-        source_input_ids = source_input_ids.tolist()
-        ctf_output_ids = (torch.ones(len(base_input_ids))*-100).long().tolist()
-        ctf_output_ids[-1] = ctf_label
         
-        all_base_input_ids += [base_input_ids]
-        all_source_input_ids += [source_input_ids]
-        all_ctf_output_ids += [ctf_output_ids]
+        all_base_prompts += [base_alpaca_prompt]
+        all_source_prompts += [source_alpaca_prompt]
+        all_ctf_labels += [ctf_label]
         all_intervention_ids += [0]
-        assert len(base_input_ids) == 82
-        assert len(source_input_ids) == 82
+    
+    all_base_input_ids, all_source_input_ids = encode_prompt_pairs(
+        tokenizer, all_base_prompts, all_source_prompts
+    )
+    all_ctf_output_ids = build_output_ids(all_base_input_ids, all_ctf_labels) # this one does not have input ids, etc..
         
     return all_base_input_ids, all_source_input_ids, all_ctf_output_ids, all_intervention_ids
 
+class TensorDictDataset(torch.utils.data.Dataset):
+    """
+    Same examples as `Dataset.from_dict(...).with_format("torch")`,
+    but every field is kept as one preallocated tensor, so indexing
+    does not go through arrow conversion.
+    """
+    def __init__(self, tensors):
+        self.tensors = tensors
+        self.n_examples = len(next(iter(tensors.values())))
+        
+    def __len__(self):
+        return self.n_examples
+    
+    def __getitem__(self, idx):
+        return {k: v[idx] for k, v in self.tensors.items()}
+
+def dataloader_kwargs(persistent_workers=False):
+    # pinned host memory lets the trainer copy batches to the GPU with
+    # non_blocking=True, and workers prefetch the next batches meanwhile.
+    num_workers = min(4, (os.cpu_count() or 1)//2)
+    kwargs = {
+        "pin_memory": torch.cuda.is_available(),
+        "num_workers": num_workers,
+    }
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["prefetch_factor"] = 4
+    return kwargs
+
 def prepare_dataloader(args, tokenizer):
+    # fail before sampling anything instead of after the prealign set is built.
+    if args.task_name not in task_names:
+        raise ValueError(f"Unknown pricing tag task: {args.task_name}")
     prealign_batch_size = args.eval_batch_size
     logger.info(
         f"""
@@ -460,14 +552,15 @@ def prepare_dataloader(args, tokenizer):
         args.n_eval_examples,
         game=args.task_name,
     )
-    prealign_dataset = Dataset.from_dict(
+    prealign_dataset = TensorDictDataset(
         {
-            "input_ids": raw_prealign[0], 
-            "labels": raw_prealign[1],
+            "input_ids": torch.tensor(raw_prealign[0], dtype=torch.long), 
+            "labels": torch.tensor(raw_prealign[1], dtype=torch.long),
         }
-    ).with_format("torch")
+    )
     prealign_dataloader = DataLoader(
-        prealign_dataset, batch_size=prealign_batch_size
+        prealign_dataset, batch_size=prealign_batch_size,
+        **dataloader_kwargs(persistent_workers=False)
     )
     
     if args.task_name == "pricing_tag_lb":
@@ -508,56 +601,37 @@ def prepare_dataloader(args, tokenizer):
             bound_width=3.00,
         )
 
-    raw_train = (
-        raw_data[0][:args.n_training_examples], 
-        raw_data[1][:args.n_training_examples], 
-        raw_data[2][:args.n_training_examples],
-        raw_data[3][:args.n_training_examples]
-    )
-    raw_eval = (
-        raw_data[0][args.n_training_examples:args.n_training_examples+args.n_eval_examples], 
-        raw_data[1][args.n_training_examples:args.n_training_examples+args.n_eval_examples], 
-        raw_data[2][args.n_training_examples:args.n_training_examples+args.n_eval_examples],
-        raw_data[3][args.n_training_examples:args.n_training_examples+args.n_eval_examples]
-    )
-    raw_test = (
-        raw_data[0][args.n_training_examples+args.n_eval_examples:], 
-        raw_data[1][args.n_training_examples+args.n_eval_examples:], 
-        raw_data[2][args.n_training_examples+args.n_eval_examples:],
-        raw_data[3][args.n_training_examples+args.n_eval_examples:]
+    # tensorize each field once; the splits below are views into these.
+    all_tensors = {
+        "input_ids": torch.tensor(raw_data[0], dtype=torch.long), 
+        "source_input_ids": torch.tensor(raw_data[1], dtype=torch.long),
+        "labels": torch.tensor(raw_data[2], dtype=torch.long),
+        "intervention_ids": torch.tensor(raw_data[3], dtype=torch.long),
+    }
+    n_train_eval = args.n_training_examples+args.n_eval_examples
+    train_dataset = TensorDictDataset(
+        {k: v[:args.n_training_examples] for k, v in all_tensors.items()}
     )
-    train_dataset = Dataset.from_dict(
-        {
-            "input_ids": raw_train[0], 
-            "source_input_ids": raw_train[1],
-            "labels": raw_train[2],
-            "intervention_ids": raw_train[3],
-        }
-    ).with_format("torch")
     train_dataloader = DataLoader(
-        train_dataset, batch_size=args.train_batch_size,
+        train_dataset, batch_size=args.train_batch_size, shuffle=True,
+        # a smaller trailing batch would force compiled CUDA graphs to be
+        # captured again for the new shape.
+        drop_last=getattr(args, "torch_compile", False),
+        **dataloader_kwargs(persistent_workers=True)
+    )
+    eval_dataset = TensorDictDataset(
+        {k: v[args.n_training_examples:n_train_eval] for k, v in all_tensors.items()}
     )
-    eval_dataset = Dataset.from_dict(
-        {
-            "input_ids": raw_eval[0], 
-            "source_input_ids": raw_eval[1],
-            "labels": raw_eval[2],
-            "intervention_ids": raw_eval[3],
-        }
-    ).with_format("torch")
     eval_dataloader = DataLoader(
         eval_dataset, batch_size=args.eval_batch_size,
+        **dataloader_kwargs(persistent_workers=True)
+    )
+    test_dataset = TensorDictDataset(
+        {k: v[n_train_eval:] for k, v in all_tensors.items()}
     )
-    test_dataset = Dataset.from_dict(
-        {
-            "input_ids": raw_test[0], 
-            "source_input_ids": raw_test[1],
-            "labels": raw_test[2],
-            "intervention_ids": raw_test[3],
-        }
-    ).with_format("torch")
     test_dataloader = DataLoader(
         test_dataset, batch_size=args.eval_batch_size,
+        **dataloader_kwargs(persistent_workers=False)
     )
     return prealign_dataloader, train_dataloader, eval_dataloader, test_dataloader
 
@@ -565,32 +639,20 @@ def sample_with_region_with_triples(
     region,
     triples
 ):
-    return random.choice(list(triples[region]))
+    region_triples = triples[region]
+    if not isinstance(region_triples, (list, tuple)):
+        region_triples = list(region_triples)
+    return random.choice(region_triples)
 
 def lower_bound_alignment_example_sampler_with_triples(
     tokenizer,
     triples,
 ):
     
-    ctf_label_str = random.choice(["Yes", "No"])
-    if ctf_label_str == "Yes":
-        ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-        base_source_regions = [
-            [1,2],
-            [1,3],
-            [2,2],
-        ]
-    elif ctf_label_str == "No":
-        ctf_label = tokenizer.convert_tokens_to_ids("No")
-        base_source_regions = [
-            [1,1],
-            [2,1],
-            [2,3],
-            [3,1],
-            [3,2],
-            [3,3]
-        ]
-    base_source_region = random.choice(base_source_regions)
+    ctf_label_code = random.choice(ctf_labels)
+    ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+    ctf_label_str = label_strs[ctf_label_code]
+    base_source_region = random.choice(lower_bound_base_source_regions[ctf_label_code])
     base_region = base_source_region[0]
     source_region = base_source_region[1]
 
@@ -610,25 +672,10 @@ def upper_bound_alignment_example_sampler_with_triples(
     tokenizer,
     triples,
 ):
-    ctf_label_str = random.choice(["Yes", "No"])
-    if ctf_label_str == "Yes":
-        ctf_label = tokenizer.convert_tokens_to_ids("Yes")
-        base_source_regions = [
-            [3,2],
-            [3,1],
-            [2,2],
-        ]
-    elif ctf_label_str == "No":
-        ctf_label = tokenizer.convert_tokens_to_ids("No")
-        base_source_regions = [
-            [1,1],
-            [1,2],
-            [1,3],
-            [2,1],
-            [2,3],
-            [3,3]
-        ]
-    base_source_region = random.choice(base_source_regions)
+    ctf_label_code = random.choice(ctf_labels)
+    ctf_label = yes_no_token_ids(tokenizer)[ctf_label_code]
+    ctf_label_str = label_strs[ctf_label_code]
+    base_source_region = random.choice(upper_bound_base_source_regions[ctf_label_code])
     base_region = base_source_region[0]
     source_region = base_source_region[1]
     
@@ -650,13 +697,18 @@ def bound_alignment_sampler_with_triples(
     bound_functors,
     triples
 ):
-    all_base_input_ids = []
-    all_source_input_ids = []
-    all_ctf_output_ids = [] # this one does not have input ids, etc..
+    all_base_prompts = []
+    all_source_prompts = []
+    all_ctf_labels = []
     all_intervention_ids = []
     
-    for _ in range(max_n_training_examples):
-        bound_functor = random.choice(bound_functors)
+    # sample from lists directly rather than copying each region every example.
+    triples = {
+        region: list(region_triples) for region, region_triples in triples.items()
+    }
+    # draw every example's bound functor up front in one call.
+    sampled_bound_functors = random.choices(bound_functors, k=max_n_training_examples)
+    for bound_functor in sampled_bound_functors:
         base_lower_bound_sample, base_upper_bound_sample, \
             source_lower_bound_sample, source_upper_bound_sample, \
             base_amount_sample, source_amount_sample, \
@@ -672,9 +724,10 @@ def bound_alignment_sampler_with_triples(
         source_lower_bound_str = "%.2f" % source_lower_bound_sample
         source_upper_bound_str = "%.2f" % source_upper_bound_sample
         
-        # print(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
-        # print(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
-        # print(f"ctf label: {ctf_label_str}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"base: [{base_lower_bound_str}, {base_upper_bound_str}], {base_amount_str}")
+            logger.debug(f"source: [{source_lower_bound_str}, {source_upper_bound_str}], {source_amount_str}")
+            logger.debug(f"ctf label: {ctf_label_str}")
         
         base_instruction = f"Please say yes only if it costs between {base_lower_bound_str} and {base_upper_bound_str} dollars, otherwise no."
         source_instruction = f"Please say yes only if it costs between {source_lower_bound_str} and {source_upper_bound_str} dollars, otherwise no."
@@ -682,21 +735,17 @@ def bound_alignment_sampler_with_triples(
         base_alpaca_prompt = alpaca_prompt_template % (base_instruction, base_amount_str)
         source_alpaca_prompt = alpaca_prompt_template % (source_instruction, source_amount_str)
         
-        base_input_ids = tokenizer(base_alpaca_prompt, return_tensors="pt").input_ids[0]
-        source_input_ids = tokenizer(source_alpaca_prompt, return_tensors="pt").input_ids[0]
-        base_input_ids = base_input_ids.tolist()
-        source_input_ids = source_input_ids.tolist()
-        ctf_output_ids = (torch.ones(len(base_input_ids))*-100).long().tolist()
-        ctf_output_ids[-1] = ctf_label
         intervention_id = 0 if bound_functor == bound_functors[0] else 1
         
-        all_base_input_ids += [base_input_ids]
-        all_source_input_ids += [source_input_ids]
+        all_base_prompts += [base_alpaca_prompt]
+        all_source_prompts += [source_alpaca_prompt]
         
-        all_ctf_output_ids += [ctf_output_ids]
+        all_ctf_labels += [ctf_label]
         all_intervention_ids += [intervention_id]
-        
-        assert len(base_input_ids) == 82
-        assert len(source_input_ids) == 82
+    
+    all_base_input_ids, all_source_input_ids = encode_prompt_pairs(
+        tokenizer, all_base_prompts, all_source_prompts
+    )
+    all_ctf_output_ids = build_output_ids(all_base_input_ids, all_ctf_labels) # this one does not have input ids, etc..
         
     return all_base_input_ids, all_source_input_ids, all_ctf_output_ids, all_intervention_ids
\ No newline at end of file
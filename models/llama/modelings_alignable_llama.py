@@ -113,6 +113,7 @@ class AlignableLlamaModel(LlamaModel):
         ########################################
         # sources related information goes here
         ########################################
+        source_input_ids=None,
         source_hidden_states=None,
         intervention_ids=None,
         output_rotated_hidden_states_only: Optional[bool] = False,
@@ -132,6 +133,15 @@ class AlignableLlamaModel(LlamaModel):
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        # source and base share the layers below the aligning layer, so they
+        # can run as one [source; base] batch that is split at that layer.
+        n_source_examples = 0
+        if source_input_ids is not None and source_hidden_states is None:
+            if attention_mask is not None or inputs_embeds is not None:
+                raise ValueError("source_input_ids can only be combined with input_ids and no attention_mask")
+            n_source_examples = source_input_ids.shape[0]
+            input_ids = torch.cat([source_input_ids, input_ids], dim=0)
+
         # retrieve input_ids and inputs_embeds
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError("You cannot specify both decoder_input_ids and decoder_inputs_embeds at the same time")
@@ -227,6 +237,19 @@ class AlignableLlamaModel(LlamaModel):
                 prefix_hidden_states = hidden_states[:,:start]
                 postfix_hidden_states = hidden_states[:,end:]
                 rotated_hidden_states = self.rotate_layer(aligning_hidden_states)
+                
+                if n_source_examples > 0:
+                    # split the fused batch: the source half only provides the
+                    # rotated states, the rest of the forward is base only.
+                    source_hidden_states = rotated_hidden_states[:n_source_examples]
+                    rotated_hidden_states = rotated_hidden_states[n_source_examples:]
+                    prefix_hidden_states = prefix_hidden_states[n_source_examples:]
+                    postfix_hidden_states = postfix_hidden_states[n_source_examples:]
+                    batch_size = batch_size - n_source_examples
+                    original_shape = (batch_size,) + tuple(original_shape[1:])
+                    attention_mask = attention_mask[n_source_examples:]
+                    if position_ids.shape[0] > 1:
+                        position_ids = position_ids[n_source_examples:]
                                 
                 # intervene
                 if source_hidden_states != None:
@@ -275,6 +298,17 @@ class AlignableLlamaModel(LlamaModel):
 
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
+                
+            if n_source_examples > 0 and idx == self.alignment_config["layer"]:
+                # outputs collected up to here still include the source rows.
+                if output_hidden_states:
+                    all_hidden_states = tuple(h[n_source_examples:] for h in all_hidden_states)
+                if use_cache:
+                    next_decoder_cache = tuple(
+                        tuple(kv[n_source_examples:] for kv in layer_cache) for layer_cache in next_decoder_cache
+                    )
+                if output_attentions:
+                    all_self_attns = tuple(a[n_source_examples:] for a in all_self_attns)
 
         hidden_states = self.norm(hidden_states)
 
@@ -363,6 +397,7 @@ class AlignableLlamaForCausalLM(LlamaForCausalLM):
             ########################################
             # sources related information goes here
             ########################################
+            source_input_ids=source_input_ids,
             source_hidden_states=source_hidden_states,
             intervention_ids=intervention_ids,
             output_rotated_hidden_states_only=output_rotated_hidden_states_only,
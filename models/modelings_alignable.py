@@ -4,16 +4,21 @@ from transformers import AutoConfig
 
 class AutoAlignableModel:
     @staticmethod
-    def from_pretrained(model_path, alignment_config=None, torch_dtype=None, cache_dir="~/.cache"):
+    def from_pretrained(model_path, alignment_config=None, torch_dtype=None, cache_dir="~/.cache", config=None):
         """
         Currently, we should always assume we are aligning a pretrained model.
+        Pass an already loaded `config` to skip parsing it again.
         """
-        if AutoConfig.from_pretrained(model_path).architectures[0] in ["AlignableLlamaForCausalLM", "LLaMAForCausalLM", "LlamaForCausalLM"]:
+        if config is None:
+            config = AutoConfig.from_pretrained(model_path)
+        architecture = config.architectures[0]
+        if architecture in ["AlignableLlamaForCausalLM", "LLaMAForCausalLM", "LlamaForCausalLM"]:
             model_class = AlignableLlamaForCausalLM
-        elif AutoConfig.from_pretrained(model_path).architectures[0] == "GPT2LMHeadModel":
+        elif architecture == "GPT2LMHeadModel":
             model_class = AlignableGPT2LMHeadModel
         return model_class.from_pretrained(
             model_path,
+            config=config,
             alignment_config=alignment_config,
             torch_dtype=torch_dtype,
             cache_dir=cache_dir
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # coding: utf-8
-import os, random, argparse, sys, torch
+import os, re, random, argparse, sys, torch
 from models.configuration_alignable_model import AlignableLlamaConfig
 from trainer import Aligner, CACHE_DIR
 import counterfactual_datasets.price_tagging_game as price_tagging_game
@@ -34,7 +34,10 @@ if __name__ == '__main__':
         )
         cmd.add_argument('--max_seq_len', default=512, type=int)
         cmd.add_argument('--seed', default=42, type=int)
-        cmd.add_argument('--gradient_accumulation_steps', default=1, type=int)
+        cmd.add_argument(
+            '--gradient_accumulation_steps', default=1, type=int,
+            help='micro-batches per optimizer step; under DDP, gradients are only all-reduced on the last one'
+        )
         cmd.add_argument('--output_dir', required=True, type=str, help='save dir')
         cmd.add_argument('--local_rank', default=-1, type=int, help='multi gpu training')
         cmd.add_argument('--epochs', default=10, type=int, help='training epochs')
@@ -43,6 +46,11 @@ if __name__ == '__main__':
         cmd.add_argument('--is_wandb', default=False, action='store_true')
         cmd.add_argument('--wandb_username', type=str, default="")
         cmd.add_argument('--bf16', default=False, action='store_true')
+        cmd.add_argument(
+            '--torch_compile', default=False, action='store_true',
+            help='wrap the model with torch.compile (requires torch>=2.0); '
+                 'the last partial training batch is dropped to keep CUDA graph shapes static'
+        )
         cmd.add_argument('--log_step', default=10, type=int)
         cmd.add_argument('--valid_steps', default=500, type=int)
         cmd.add_argument('--early_stopping', default=5, type=int)
@@ -59,6 +67,11 @@ if __name__ == '__main__':
         assert False
 
 set_seed(args.seed)
+# every batch has the same shape, so let cudnn pick and cache its fastest
+# kernels, and allow TF32 tensor cores for any remaining fp32 matmuls.
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+torch.backends.cudnn.allow_tf32 = True
 
 ###################
 # data loaders
@@ -67,8 +80,10 @@ tokenizer = AutoTokenizer.from_pretrained(
     pretrained_model_name_or_path=args.model_path,
     cache_dir=CACHE_DIR
 )
-if args.task_name in ["pricing_tag_lb", "pricing_tag_lub", "pricing_tag_mid_diff", "pricing_tag_bracket", "pricing_tag_fixed"]:
+if args.task_name in price_tagging_game.task_names:
     prepare_dataloader_fn = price_tagging_game.prepare_dataloader
+else:
+    raise ValueError(f"Unknown task name: {args.task_name}")
 prealign_dataloader, train_dataloader, eval_dataloader, test_dataloader = prepare_dataloader_fn(
     args, tokenizer
 )
@@ -87,19 +102,19 @@ alignment_config = {
     ]
 }
 logger.info(f"alignment_config = {alignment_config}")
-model_type = AutoConfig.from_pretrained(args.model_path).architectures[0]
+model_config = AutoConfig.from_pretrained(args.model_path, cache_dir=CACHE_DIR)
+model_type = model_config.architectures[0]
 
 run_name = f"{model_type}.task.{args.task_name}."\
            f"seed.{args.seed}.intl.{alignment_config['layer']}.intr.{alignment_config['token_range'][0]}."\
            f"{alignment_config['token_range'][1]}"
 
 is_master = True
-if not os.path.exists(args.output_dir) and is_master:
-    os.mkdir(args.output_dir)
 os.environ["WANDB_PROJECT"] = f"Boundless-DAS"
 output_dir = os.path.join(args.output_dir, run_name)
-if not os.path.exists(output_dir) and is_master:
-    os.mkdir(output_dir)
+if is_master:
+    # also creates args.output_dir; safe if another rank got there first.
+    os.makedirs(output_dir, exist_ok=True)
     
 # now we check whether we can skip ...
 # if there is last, we need to skip!
@@ -112,44 +127,59 @@ das_config.save_pretrained(os.path.join(args.output_dir, run_name, "das_config")
 logger.info(f"Loading Pretrained LLM with bf16 = {args.bf16}...")
 model = AutoAlignableModel.from_pretrained(
     args.model_path,
+    config=model_config,
     alignment_config=alignment_config,
-    torch_dtype=torch.bfloat16 if args.bf16 else None,
+    # without --bf16 we load full fp32 weights; their matmuls still run on
+    # TF32 tensor cores through the matmul precision set above.
+    torch_dtype=torch.bfloat16 if args.bf16 else torch.float32,
     cache_dir=CACHE_DIR
 )
+if args.bf16:
+    # the frozen base model stays in bf16, but the trained rotation and
+    # boundaries keep fp32 master weights; the Aligner's autocast runs the
+    # matmuls that mix them with bf16 activations in bf16.
+    model.model.rotate_layer.float()
+    model.model.intervention_boundaries.data = model.model.intervention_boundaries.data.float()
 
 # set off the gradients among all other layers.
+trainable_param_pattern = re.compile(r"rotate_layer|intervention_boundaries")
 for name, param in model.named_parameters():
-    if "rotate_layer" not in name and "intervention_boundaries" not in name:
-        param.requires_grad = False
-    else:
+    param.requires_grad = trainable_param_pattern.search(name) is not None
+    if param.requires_grad:
         logger.info(f"Requiring gradients on layer: {name}")
 
+device = "cuda"
+model.to(device)
+if args.torch_compile:
+    # every prompt has the same token length, so "reduce-overhead"
+    # can replay captured CUDA graphs instead of relaunching every kernel.
+    # leave room for the source / intervened variants of the forward.
+    torch._dynamo.config.cache_size_limit = 64
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+
 t_total = int(len(train_dataloader) * args.epochs)
 warm_up_steps = args.warm_up * t_total
 optimizer = torch.optim.Adam(
     [{'params': model.model.rotate_layer.parameters()},
     {'params': model.model.intervention_boundaries, 'lr': 1e-2}],
-    lr=args.lr
+    lr=args.lr,
+    # a single fused kernel for the few alignment params; CUDA only.
+    fused=(device == "cuda")
 )
 scheduler = get_linear_schedule_with_warmup(
     optimizer, num_warmup_steps=warm_up_steps,
     num_training_steps=t_total
 )
 
-device = "cuda"
-model.to(device)
-
 # You can define your custom compute_metrics function.
 def compute_metrics(eval_preds, eval_labels):
-    total_count = 0
-    correct_count = 0
-    for eval_pred, eval_label in zip(eval_preds, eval_labels):
-        actual_test_labels = eval_label[:, -1]
-        pred_test_labels = torch.argmax(eval_pred[:, -1], dim=-1)
-        correct_labels = (actual_test_labels==pred_test_labels)
-        total_count += len(correct_labels)
-        correct_count += correct_labels.sum().tolist()
-    accuracy = round(correct_count/total_count, 2)
+    # reduce on device and sync once, rather than once per batch.
+    actual_test_labels = torch.cat([eval_label[:, -1] for eval_label in eval_labels])
+    pred_test_labels = torch.cat(
+        [torch.argmax(eval_pred[:, -1], dim=-1) for eval_pred in eval_preds]
+    )
+    correct_labels = (actual_test_labels==pred_test_labels)
+    accuracy = round(correct_labels.sum().item()/len(correct_labels), 2)
     return {"accuracy" : accuracy}
 
 if args.is_wandb:
@@ -172,7 +202,8 @@ aligner = Aligner(
     n_gpu=torch.cuda.device_count(),
     model_name=run_name,
     device=device,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    bf16=args.bf16
 )
 
 # Prealign Eval is a must
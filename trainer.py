@@ -1,4 +1,4 @@
-import os, random, argparse, sys, pickle, time
+import os, random, argparse, sys, pickle, time, inspect
 import torch
 from tqdm import tqdm, trange
 import numpy as np
@@ -6,7 +6,14 @@ import pandas as pd
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 from datasets import Dataset 
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+try:
+    import wandb
+except ImportError:
+    wandb = None
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -24,6 +31,16 @@ to larger models as well if computation resource
 is allowed.
 """
 CACHE_DIR = "../.cache/"
+COMPILE_CACHE_PATH = os.path.join(CACHE_DIR, "torch_compile_artifacts.bin")
+
+def unwrap_model(model):
+    while hasattr(model, "module") or hasattr(model, "_orig_mod"):
+        model = model.module if hasattr(model, "module") else model._orig_mod
+    return model
+
+def compile_cache_supported():
+    # portable compile caches only exist in newer torch releases.
+    return hasattr(torch, "compiler") and hasattr(torch.compiler, "save_cache_artifacts")
 
 class Aligner(object):
     def __init__(
@@ -39,7 +56,8 @@ class Aligner(object):
         early_stopping=5,
         do_statistic=False,
         model_name="",
-        device="cuda"
+        device="cuda",
+        bf16=False
     ):
         self.model = model
         num_params = count_parameters(model)
@@ -53,40 +71,134 @@ class Aligner(object):
         self.lr = lr
         self.n_gpu = n_gpu
         self.device = device
+        self.bf16 = bf16
+        self.is_ddp = isinstance(model, DDP)
+        # models wrapped by torch.compile keep the original module here.
+        self.is_compiled = hasattr(model, "_orig_mod")
+        # the inner model holding the rotate layer, boundaries and temperature,
+        # looked up once through any DataParallel / DDP / torch.compile wrapper.
+        self.alignable_model = unwrap_model(model).model
+        # models that can take source_input_ids run source and base as one
+        # batched forward instead of two sequential ones.
+        self.fuses_source_forward = "source_input_ids" in inspect.signature(
+            unwrap_model(model).forward
+        ).parameters
+        # only the rotation and boundaries are trained; collected once here so
+        # backward can stop at them without walking the modules every step.
+        self.learnable_params = [
+            p for p in unwrap_model(model).parameters() if p.requires_grad
+        ]
         
         self.early_stopping = early_stopping
+        # checkpoints are written by a background thread so training doesn't
+        # wait on disk; at most one save is in flight at a time.
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._last_save_future = None
+        # load cached compile artifacts before prealign_eval makes the first
+        # compiled call; they are saved again at the end of train().
+        self.load_compile_cache()
+    
+    def autocast(self):
+        # with --bf16 the base weights are bf16 while the rotation and
+        # boundaries stay fp32; autocast keeps the mixed matmuls in bf16.
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=torch.bfloat16,
+            enabled=self.bf16
+        )
+    
+    def load_compile_cache(self):
+        if self.is_compiled and compile_cache_supported() and os.path.isfile(COMPILE_CACHE_PATH):
+            logger.info(f"Loading torch.compile artifacts from {COMPILE_CACHE_PATH}")
+            with open(COMPILE_CACHE_PATH, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+    
+    def save_compile_cache(self):
+        # lets the next run skip the cold compile of the same graphs.
+        if not (self.is_compiled and compile_cache_supported()):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(COMPILE_CACHE_PATH, "wb") as f:
+                f.write(artifacts[0])
+    
+    def _move_inputs(self, inputs):
+        # non_blocking only overlaps the copy with compute when the
+        # dataloader hands out pinned batches (pin_memory=True).
+        return {
+            k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+            for k, v in inputs.items()
+        }
+    
+    def _last_position(self, tensor):
+        # metrics only score the last position, so don't keep every eval
+        # batch's full [batch, seq, vocab] logits on the device.
+        return tensor[:, -1:].clone()
+    
+    def aligning_forward(self, inputs):
+        if self.fuses_source_forward and \
+            inputs['source_input_ids'].shape == inputs['input_ids'].shape:
+            return self.model(
+                input_ids=inputs['input_ids'],
+                source_input_ids=inputs['source_input_ids'],
+                intervention_ids=inputs['intervention_ids'],
+                labels=inputs['labels']
+            )
+        source_hidden_states = self.model(
+            input_ids=inputs['source_input_ids'],
+            output_rotated_hidden_states_only=True
+        ).rotated_hidden_states
+        return self.model(
+            input_ids=inputs['input_ids'],
+            source_hidden_states=source_hidden_states,
+            intervention_ids=inputs['intervention_ids'],
+            labels=inputs['labels']
+        )
     
     def save_model(self, output_dir, model_name):
-        if self.n_gpu > 1:
-            torch.save({
-                'rotate_layer': self.model.module.model.rotate_layer.state_dict(),
-                'intervention_boundaries': self.model.module.model.intervention_boundaries,
-                'temperature': self.model.module.model.temperature
-            }, os.path.join(output_dir, model_name))
-        else:
-            torch.save({
-                'rotate_layer': self.model.model.rotate_layer.state_dict(),
-                'intervention_boundaries': self.model.model.intervention_boundaries,
-                'temperature': self.model.model.temperature
-                
-            }, os.path.join(output_dir, model_name))
+        # snapshot now, so later optimizer steps can't change what ends up on
+        # disk. the rotation goes to host memory; the small boundary and
+        # temperature tensors keep their device since eval notebooks assign
+        # them straight into .data.
+        state = {
+            'rotate_layer': {
+                k: v.detach().to("cpu", copy=True) for k, v in self.alignable_model.rotate_layer.state_dict().items()
+            },
+            'intervention_boundaries': self.alignable_model.intervention_boundaries.detach().clone(),
+            'temperature': self.alignable_model.temperature.detach().clone()
+        }
+        self.wait_for_save()
+        self._last_save_future = self._save_pool.submit(
+            torch.save, state, os.path.join(output_dir, model_name)
+        )
+    
+    def wait_for_save(self, reraise=True):
+        if self._last_save_future is None:
+            return
+        future, self._last_save_future = self._last_save_future, None
+        # exception() blocks until the background save is done.
+        error = future.exception()
+        if error is not None:
+            if reraise:
+                raise error
+            logger.error(f"Saving checkpoint in the background failed: {error!r}")
     
     def prealign_eval(self, prealign_dataloader, output_dir):
         eval_labels = []
         eval_preds = []
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             for step, inputs in enumerate(prealign_dataloader):
-                for k, v in inputs.items():
-                    if v is not None and isinstance(v, torch.Tensor):
-                        inputs[k] = v.to(self.device)
+                inputs = self._move_inputs(inputs)
                 # aligning forward!
-                outputs = self.model(
-                    input_ids=inputs['input_ids'],
-                    labels=inputs['labels']
-                )
-                eval_labels += [inputs['labels']]
-                eval_preds += [outputs.logits]
+                with self.autocast():
+                    outputs = self.model(
+                        input_ids=inputs['input_ids'],
+                        labels=inputs['labels']
+                    )
+                eval_labels += [self._last_position(inputs['labels'])]
+                eval_preds += [self._last_position(outputs.logits)]
         eval_metrics = self.compute_metrics_fn(eval_preds, eval_labels)
         logger.info(f"[WARNING: THIS NEEDS TO BE GOOD!] prealign task accuracy: {eval_metrics['accuracy']}")
         
@@ -108,182 +220,189 @@ class Aligner(object):
         log_step, valid_steps, epochs, 
         gradient_accumulation_steps,
     ):
+        # the log files stay open (line-buffered) for the whole run.
+        log_train = None
+        log_eval = None
         if self.is_master and not self.is_wandb:
             log_train = open(os.path.join(output_dir, 'train_log.txt'), 'w', buffering=1)
             log_eval = open(os.path.join(output_dir, 'eval_log.txt'), 'w', buffering=1)
             print('step,loss,accuracy', file=log_train)
             print('step,accuracy', file=log_eval)
-            log_train.close()
-            log_eval.close()
 
-        # okay, have to honest, not sure whether we do train mode align or eval align;
-        # i guess it is good to try both, but ... only trying train here and move on.
-        self.model.train()
-        train_iterator = trange(
-            0, int(epochs), desc="Epoch"
-        )
-        total_step = 0
-        total_log_step = 0
-        best_eval_acc = -1
-        target_total_step = len(train_dataloader) * int(epochs)
-        temperature_start = 50.0
-        temperature_end = 0.1
-        temperature_schedule = torch.linspace(temperature_start, temperature_end, target_total_step).to(torch.bfloat16)
-        self.model.model.temperature.data = temperature_schedule[total_step]
+        try:
+            # okay, have to honest, not sure whether we do train mode align or eval align;
+            # i guess it is good to try both, but ... only trying train here and move on.
+            self.model.train()
+            train_iterator = trange(
+                0, int(epochs), desc="Epoch"
+            )
+            total_step = 0
+            total_log_step = 0
+            best_eval_acc = -1
+            target_total_step = len(train_dataloader) * int(epochs)
+            temperature_start = 50.0
+            temperature_end = 0.1
+            # the schedule lives on the device and is copied into the existing
+            # temperature parameter, so updates never go through the host.
+            temperature_schedule = torch.linspace(
+                temperature_start, temperature_end, target_total_step, device=self.device
+            ).to(torch.bfloat16)
+            self.alignable_model.temperature.data.copy_(temperature_schedule[total_step])
         
-        for epoch in train_iterator:
-            epoch_iterator = tqdm(train_dataloader, desc=f"Epoch: {epoch}", position=0, leave=True)
-            for step, inputs in enumerate(epoch_iterator):
-                
+            for epoch in train_iterator:
+                # the bar only needs redrawing about as often as the loss changes.
+                epoch_iterator = tqdm(
+                    train_dataloader, desc=f"Epoch: {epoch}", position=0, leave=True,
+                    miniters=log_step, mininterval=1.0
+                )
+                for step, inputs in enumerate(epoch_iterator):
                 
-                for k, v in inputs.items():
-                    if v is not None and isinstance(v, torch.Tensor):
-                        inputs[k] = v.to(self.device)
                 
-                # aligning forward!
-                source_hidden_states = self.model(
-                   input_ids=inputs['source_input_ids'],
-                   output_rotated_hidden_states_only=True
-                ).rotated_hidden_states
+                    inputs = self._move_inputs(inputs)
                 
-                outputs = self.model(
-                    input_ids=inputs['input_ids'],
-                    source_hidden_states=source_hidden_states,
-                    intervention_ids=inputs['intervention_ids'],
-                    labels=inputs['labels']
-                )
+                    # aligning forward!
+                    with self.autocast():
+                        outputs = self.aligning_forward(inputs)
                 
-                loss = outputs.loss.mean() if self.n_gpu > 1 else outputs.loss
-                step_accuracy = self.compute_metrics_fn([outputs.logits], [inputs['labels']])['accuracy']
-
-                if self.is_master and total_step % log_step == 0:
-                    if self.is_wandb:
-                        intervention_boundaries = torch.clamp(self.model.model.intervention_boundaries, 1e-3, 1)
-                        wandb.log(
-                            {
-                                "train/loss": loss.item(),
-                                "train/step_accuracy": step_accuracy,
-                                "train/temperature": self.model.model.temperature.data,
-                                "train/unified_boundary": intervention_boundaries.data[0],
-                                "train/unified_boundary (dummy)": intervention_boundaries.data[1],                                       
-                            },
-                            step=total_step
-                        )
-                    else:
-                        log_train = open(os.path.join(output_dir, 'train_log.txt'), 'a', buffering=1)
-                        print('{},{},{}'.format(
-                                total_step, loss.item(), step_accuracy
-                            ),
-                            file=log_train
-                        )
-                        log_train.close()
-                        
-                    if total_step != 0 and total_step % valid_steps == 0:
-                        eval_labels = []
-                        eval_preds = []
-                        self.model.eval()
-                        with torch.no_grad():
-                            for step, inputs in enumerate(dev_dataloader):
-                                for k, v in inputs.items():
-                                    if v is not None and isinstance(v, torch.Tensor):
-                                        inputs[k] = v.to(self.device)
+                    loss = outputs.loss.mean() if self.n_gpu > 1 else outputs.loss
 
-                                # aligning forward!
-                                source_hidden_states = self.model(
-                                    input_ids=inputs['source_input_ids'],
-                                    output_rotated_hidden_states_only=True
-                                ).rotated_hidden_states
-                                outputs = self.model(
-                                    input_ids=inputs['input_ids'],
-                                    source_hidden_states=source_hidden_states,
-                                    intervention_ids=inputs['intervention_ids'],
-                                    labels=inputs['labels']
-                                )
-
-                                eval_labels += [inputs['labels']]
-                                eval_preds += [outputs.logits]
-                        eval_metrics = self.compute_metrics_fn(eval_preds, eval_labels)
-                        
+                    if self.is_master and total_step % log_step == 0:
+                        # the metric syncs with the host, so only pay for it when logging.
+                        step_accuracy = self.compute_metrics_fn(
+                            [self._last_position(outputs.logits.detach())], [inputs['labels']]
+                        )['accuracy']
                         if self.is_wandb:
+                            # bring all logged scalars to the host in one copy instead
+                            # of letting wandb sync on each device tensor separately.
+                            intervention_boundaries = torch.clamp(self.alignable_model.intervention_boundaries, 1e-3, 1)
+                            loss_value, temperature, unified_boundary, dummy_boundary = torch.cat([
+                                loss.detach().float().reshape(1),
+                                self.alignable_model.temperature.detach().float().reshape(1),
+                                intervention_boundaries.detach().float(),
+                            ]).tolist()
                             wandb.log(
                                 {
-                                    "eval/accuracy": eval_metrics['accuracy']
+                                    "train/loss": loss_value,
+                                    "train/step_accuracy": step_accuracy,
+                                    "train/temperature": temperature,
+                                    "train/unified_boundary": unified_boundary,
+                                    "train/unified_boundary (dummy)": dummy_boundary,                                       
                                 },
                                 step=total_step
                             )
                         else:
-                            log_eval = open(os.path.join(output_dir, 'eval_log.txt'), 'a', buffering=1)
-                            print('{},{}'.format(total_step, eval_metrics['accuracy']), file=log_eval)
-                            log_eval.close()
+                            loss_value = loss.item()
+                            print('{},{},{}'.format(
+                                    total_step, loss_value, step_accuracy
+                                ),
+                                file=log_train
+                            )
+                        # reading the loss syncs with the device, so the bar
+                        # only shows the value from the last log step.
+                        epoch_iterator.set_postfix({'loss': round(loss_value, 2)}, refresh=False)
+                        
+                        if total_step != 0 and total_step % valid_steps == 0:
+                            eval_labels = []
+                            eval_preds = []
+                            self.model.eval()
+                            with torch.inference_mode():
+                                for step, inputs in enumerate(dev_dataloader):
+                                    inputs = self._move_inputs(inputs)
+
+                                    # aligning forward!
+                                    with self.autocast():
+                                        outputs = self.aligning_forward(inputs)
+
+                                    eval_labels += [self._last_position(inputs['labels'])]
+                                    eval_preds += [self._last_position(outputs.logits)]
+                            eval_metrics = self.compute_metrics_fn(eval_preds, eval_labels)
+                        
+                            if self.is_wandb:
+                                wandb.log(
+                                    {
+                                        "eval/accuracy": eval_metrics['accuracy']
+                                    },
+                                    step=total_step
+                                )
+                            else:
+                                print('{},{}'.format(total_step, eval_metrics['accuracy']), file=log_eval)
                             
-                        if eval_metrics['accuracy'] > best_eval_acc:
-                            best_eval_acc = eval_metrics['accuracy']
-                            if self.is_master:
-                                self.save_model(output_dir, 'pytorch-rotate-best.bin')
-                        self.model.train()
+                            if eval_metrics['accuracy'] > best_eval_acc:
+                                best_eval_acc = eval_metrics['accuracy']
+                                if self.is_master:
+                                    self.save_model(output_dir, 'pytorch-rotate-best.bin')
+                            self.model.train()
 
-                    total_log_step += 1
-                loss_str = round(loss.item(), 2)
-                epoch_iterator.set_postfix({'loss': loss_str})
+                        total_log_step += 1
                 
-                if gradient_accumulation_steps > 1:
-                    loss = loss / gradient_accumulation_steps
+                    if gradient_accumulation_steps > 1:
+                        loss = loss / gradient_accumulation_steps
                 
-                if total_step % gradient_accumulation_steps == 0:
-                    if not (gradient_accumulation_steps > 1 and total_step == 0):
-                        loss.backward()
+                    # accumulate gradients over every micro-step; under DDP only the
+                    # last micro-step of each accumulation window all-reduces them.
+                    is_update_step = (total_step + 1) % gradient_accumulation_steps == 0
+                    if self.is_ddp and not is_update_step:
+                        sync_context = self.model.no_sync()
+                    else:
+                        sync_context = nullcontext()
+                    with sync_context:
+                        loss.backward(inputs=self.learnable_params)
+                
+                    if is_update_step:
                         optimizer.step()
                         scheduler.step()
-                        self.model.zero_grad()
-                        self.model.model.temperature.data = temperature_schedule[total_step]
+                        # only the optimizer's params ever get grads, so clear those
+                        # rather than walking every parameter of the base model.
+                        optimizer.zero_grad(set_to_none=True)
+                        self.alignable_model.temperature.data.copy_(temperature_schedule[total_step])
                     
-                total_step += 1
+                    total_step += 1
                 
-        logger.info("Training is finished ...") 
+            logger.info("Training is finished ...") 
+            if self.is_master:
+                self.save_compile_cache()
         
-        ###############################
-        # End of training evaluation.
-        if self.is_master:
-            self.model.eval()
-            eval_labels = []
-            eval_preds = []
-            with torch.no_grad():
-                for step, inputs in enumerate(test_dataloader):
-                    for k, v in inputs.items():
-                        if v is not None and isinstance(v, torch.Tensor):
-                            inputs[k] = v.to(self.device)
+            ###############################
+            # End of training evaluation.
+            if self.is_master:
+                self.model.eval()
+                eval_labels = []
+                eval_preds = []
+                with torch.inference_mode():
+                    for step, inputs in enumerate(test_dataloader):
+                        inputs = self._move_inputs(inputs)
 
-                    # aligning forward!
-                    source_hidden_states = self.model(
-                        input_ids=inputs['source_input_ids'],
-                        output_rotated_hidden_states_only=True
-                    ).rotated_hidden_states
-                    outputs = self.model(
-                        input_ids=inputs['input_ids'],
-                        source_hidden_states=source_hidden_states,
-                        intervention_ids=inputs['intervention_ids'],
-                        labels=inputs['labels']
-                    )
+                        # aligning forward!
+                        with self.autocast():
+                            outputs = self.aligning_forward(inputs)
                     
-                    eval_labels += [inputs['labels']]
-                    eval_preds += [outputs.logits]
-            eval_metrics = self.compute_metrics_fn(eval_preds, eval_labels)
+                        eval_labels += [self._last_position(inputs['labels'])]
+                        eval_preds += [self._last_position(outputs.logits)]
+                eval_metrics = self.compute_metrics_fn(eval_preds, eval_labels)
             
-            if self.is_wandb:
-                wandb.log(
-                    {
-                        "test/accuracy": eval_metrics['accuracy']
-                    },
-                    step=total_step
-                )
-                wandb.finish()
-            else:
-                log_eval = open(os.path.join(output_dir, 'eval_log.txt'), 'a', buffering=1)
-                print('{},{}'.format(total_step, eval_metrics['accuracy']), file=log_eval)
-                log_eval.close()
-        ###############################
+                if self.is_wandb:
+                    wandb.log(
+                        {
+                            "test/accuracy": eval_metrics['accuracy']
+                        },
+                        step=total_step
+                    )
+                    wandb.finish()
+                else:
+                    print('{},{}'.format(total_step, eval_metrics['accuracy']), file=log_eval)
+            ###############################
         
-        if self.is_master:
-            self.save_model(output_dir, 'pytorch-rotate-last.bin')
+            if self.is_master:
+                self.save_model(output_dir, 'pytorch-rotate-last.bin')
+        except BaseException:
+            # a failed background save must not mask the training error.
+            self.wait_for_save(reraise=False)
+            raise
+        else:
+            self.wait_for_save()
+        finally:
+            if log_train is not None:
+                log_train.close()
+                log_eval.close()
 
         
\ No newline at end of file